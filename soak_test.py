@@ -0,0 +1,504 @@
+import os
+import sys
+import json
+import time
+import errno
+import random
+import hashlib
+import shutil
+import logging
+import sqlite3
+import argparse
+import tempfile
+import threading
+import tracemalloc
+from array import array
+from pathlib import Path
+
+import xml_organizer as xo
+
+COMPANIES = [(f"{10000000 + i:08d}0001{i % 100:02d}", f"EMPRESA SOAK {i:02d} LTDA") for i in range(20)]
+INVALID_DOCUMENTS = [
+    "<html><body>Erro 500</body></html>",
+    '<?xml version="1.0"?><retConsSitNFe><cStat>217</cStat></retConsSitNFe>',
+    "<nfeProc><NFe><infNFe",
+    "",
+]
+
+class FaultInjector:
+    # Envolve mkdir/exists/unlink/shutil.move apenas para caminhos do "drive de rede",
+    # simulando latência de metadados, EIO esporádico e travamentos do /mnt/r
+    def __init__(self, network_root: Path, latency_ms: tuple, eio_rate: float,
+                 stall_rate: float, stall_seconds: float, seed: int):
+        self.network_root = str(network_root)
+        self.latency_ms = latency_ms
+        self.eio_rate = eio_rate
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = {"operacoes": 0, "eio": 0, "travamentos": 0}
+        self.on_archived = None
+        self._originals = {}
+
+    def _is_network(self, path) -> bool:
+        return str(path).startswith(self.network_root)
+
+    def _inject(self, operation: str, path):
+        with self.lock:
+            self.counters["operacoes"] += 1
+            latency = self.random.uniform(*self.latency_ms) / 1000
+            stall = self.random.random() < self.stall_rate
+            eio = self.random.random() < self.eio_rate
+            if stall:
+                self.counters["travamentos"] += 1
+            if eio:
+                self.counters["eio"] += 1
+
+        time.sleep(latency + (self.stall_seconds if stall else 0))
+        if eio:
+            raise OSError(errno.EIO, f"{os.strerror(errno.EIO)} (injetado em {operation})", str(path))
+
+    def install(self):
+        injector = self
+        original_mkdir = Path.mkdir
+        original_exists = Path.exists
+        original_unlink = Path.unlink
+        original_move = shutil.move
+        self._originals = {"mkdir": original_mkdir, "exists": original_exists,
+                           "unlink": original_unlink, "move": original_move}
+
+        def mkdir(self, *args, **kwargs):
+            if injector._is_network(self):
+                injector._inject("mkdir", self)
+            return original_mkdir(self, *args, **kwargs)
+
+        def exists(self, *args, **kwargs):
+            if injector._is_network(self):
+                injector._inject("exists", self)
+            return original_exists(self, *args, **kwargs)
+
+        def unlink(self, *args, **kwargs):
+            if injector._is_network(self):
+                injector._inject("unlink", self)
+            return original_unlink(self, *args, **kwargs)
+
+        def move(src, dst, *args, **kwargs):
+            if not injector._is_network(dst):
+                return original_move(src, dst, *args, **kwargs)
+            injector._inject("move", dst)
+            result = original_move(src, dst, *args, **kwargs)
+            if injector.on_archived and not str(dst).startswith(str(xo.ERROR_DIRECTORY)):
+                injector.on_archived(Path(dst).name)
+            return result
+
+        Path.mkdir, Path.exists, Path.unlink, shutil.move = mkdir, exists, unlink, move
+
+    def uninstall(self):
+        if self._originals:
+            Path.mkdir = self._originals["mkdir"]
+            Path.exists = self._originals["exists"]
+            Path.unlink = self._originals["unlink"]
+            shutil.move = self._originals["move"]
+            self._originals = {}
+
+def build_chave(seq: int) -> str:
+    return f"35{seq:042d}"
+
+def build_file_name(seq: int) -> str:
+    return f"soak_{seq:09d}.xml"
+
+def build_nfe(seq: int, cnpj: str, nome: str, data_emissao: str) -> str:
+    chave = build_chave(seq)
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f'<nfeProc xmlns="{xo.NFE_NAMESPACE}" versao="4.00"><NFe>'
+        f'<infNFe Id="NFe{chave}" versao="4.00">'
+        f'<ide><mod>{"55" if seq % 3 else "65"}</mod><serie>1</serie><nNF>{seq}</nNF>'
+        f'<dhEmi>{data_emissao}T10:00:00-03:00</dhEmi></ide>'
+        f'<emit><CNPJ>{cnpj}</CNPJ><xNome>{nome}</xNome></emit>'
+        f'<total><ICMSTot><vNF>{seq % 1000}.00</vNF></ICMSTot></total>'
+        '</infNFe></NFe>'
+        '<protNFe><infProt><cStat>100</cStat></infProt></protNFe></nfeProc>'
+    )
+
+class Producer(threading.Thread):
+    # Simula a automação que baixa XMLs para a origem, incluindo gravações lentas,
+    # reenvios do mesmo conteúdo e XMLs inválidos repetidos
+    def __init__(self, source: Path, rate: float, dup_rate: float, invalid_rate: float,
+                 slow_write_rate: float, seed: int):
+        super().__init__(daemon=True)
+        self.source = source
+        self.rate = rate
+        self.dup_rate = dup_rate
+        self.invalid_rate = invalid_rate
+        self.slow_write_rate = slow_write_rate
+        self.random = random.Random(seed)
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.counters = {"validos": 0, "duplicados": 0, "invalidos": 0, "gravacao_lenta": 0}
+        self._contents = []
+        self._invalid_contents = []
+        
+        # Estruturas compactas para não confundir o crescimento de memória do
+        # harness com o do organizer: 8 bytes por arquivo gerado e por arquivado.
+        # origins[seq - 1] é a nota de origem do conteúdo (reenvios apontam para a
+        # original) ou, negativo, a primeira ocorrência de um conteúdo inválido
+        self.origins = array("q")
+        self.invalid_hashes = {}
+        self.dropped_at = {}
+        self.archived = 0
+        self.archive_latencies = array("d")
+
+    def is_valid_key(self, chave: str) -> bool:
+        seq = int(chave[2:]) if chave.startswith("35") and chave[2:].isdigit() else 0
+        return 0 < seq <= len(self.origins) and self.origins[seq - 1] == seq
+
+    def record_archived(self, name: str):
+        with self.lock:
+            self.archived += 1
+            dropped = self.dropped_at.pop(name, None)
+            if dropped is not None:
+                self.archive_latencies.append(time.time() - dropped)
+
+    def prune(self, max_age: float):
+        # Reenvios descartados como duplicata nunca chegam ao destino
+        limit = time.time() - max_age
+        with self.lock:
+            for name in [n for n, t in self.dropped_at.items() if t < limit]:
+                del self.dropped_at[name]
+
+    def _remember(self, pool: list, item: tuple):
+        if len(pool) < 500:
+            pool.append(item)
+        else:
+            pool[self.random.randrange(500)] = item
+
+    def _write(self, path: Path, content: str):
+        tmp = path.with_suffix(".tmp")
+        if self.random.random() < self.slow_write_rate and len(content) > 10:
+            # Grava em partes já com o nome final, como um download em andamento
+            self.counters["gravacao_lenta"] += 1
+            half = len(content) // 2
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(content[:half])
+                f.flush()
+                self.stop_event.wait(self.random.uniform(1, 3))
+                f.write(content[half:])
+        else:
+            tmp.write_text(content, encoding="utf-8")
+            os.replace(tmp, path)
+
+    def run(self):
+        seq = 0
+        interval = 1 / self.rate
+        while not self.stop_event.is_set():
+            seq += 1
+            name = build_file_name(seq)
+            roll = self.random.random()
+
+            if roll < self.invalid_rate:
+                # Metade repete um inválido anterior (quarentena), metade é um conteúdo
+                # novo: uma cópia perdida não fica escondida atrás de outra idêntica
+                if self._invalid_contents and self.random.random() < 0.5:
+                    origin, content = self.random.choice(self._invalid_contents)
+                else:
+                    origin, content = seq, f"{self.random.choice(INVALID_DOCUMENTS)}<!-- {seq} -->"
+                    self.invalid_hashes[seq] = hashlib.md5(content.encode("utf-8")).hexdigest()
+                    self._remember(self._invalid_contents, (origin, content))
+                self.origins.append(-origin)
+                self.counters["invalidos"] += 1
+            else:
+                if roll < self.invalid_rate + self.dup_rate and self._contents:
+                    origin, content = self.random.choice(self._contents)
+                    self.counters["duplicados"] += 1
+                else:
+                    cnpj, nome = self.random.choice(COMPANIES)
+                    data = time.strftime("%Y-%m-%d", time.localtime(time.time() - self.random.randint(0, 700) * 86400))
+                    origin, content = seq, build_nfe(seq, cnpj, nome, data)
+                    self.counters["validos"] += 1
+                    self._remember(self._contents, (origin, content))
+                self.origins.append(origin)
+                # Reenvios também podem ser arquivados quando a cópia original foi para _ERROS
+                with self.lock:
+                    self.dropped_at[name] = time.time()
+
+            self._write(self.source / name, content)
+            self.stop_event.wait(self.random.expovariate(1 / interval))
+
+def read_rss_kb() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        return 0
+
+def sample_memory(elapsed: float, trace_memory: bool) -> tuple:
+    heap = 0
+    if trace_memory:
+        # Só o que foi alocado por xml_organizer.py (caches, conexões, fingerprints)
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(True, xo.__file__)])
+        heap = sum(stat.size for stat in snapshot.statistics("filename"))
+    return (elapsed, read_rss_kb(), heap)
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def check_consistency(producer: Producer, verify_sample: int, seed: int) -> dict:
+    issues = []
+    destination = xo.DESTINATION_NETWORK_DIRECTORY
+    archived_files = {
+        str(p) for p in destination.rglob("*.xml")
+        if not str(p).startswith(str(xo.ERROR_DIRECTORY))
+    }
+
+    conn = sqlite3.connect(xo.DATABASE_FILE)
+    rows = conn.execute("SELECT chave_acesso, caminho_arquivo FROM nota_fiscal").fetchall()
+    quarantined = conn.execute("SELECT COALESCE(SUM(ocorrencias), 0) FROM arquivo_invalido").fetchone()[0]
+    conn.close()
+
+    db_paths = {caminho for _, caminho in rows}
+    db_keys = {chave for chave, _ in rows}
+
+    rows_without_file = db_paths - archived_files
+    files_without_row = archived_files - db_paths
+    if rows_without_file:
+        issues.append(f"{len(rows_without_file)} registro(s) sem arquivo no destino")
+    if files_without_row:
+        issues.append(f"{len(files_without_row)} arquivo(s) no destino sem registro no banco")
+    if len(db_keys) != len(rows):
+        issues.append("chaves de acesso repetidas no banco")
+    unknown_keys = [chave for chave in db_keys if not producer.is_valid_key(chave)]
+    if unknown_keys:
+        issues.append(f"{len(unknown_keys)} chave(s) no banco que não foram geradas")
+
+    sample = sorted(archived_files)
+    if verify_sample and len(sample) > verify_sample:
+        sample = random.Random(seed).sample(sample, verify_sample)
+    truncated = [p for p in sample if xo.get_xml_info(Path(p)) is None]
+    if truncated:
+        issues.append(f"{len(truncated)} arquivo(s) arquivado(s) ilegível(is) (ex.: {Path(truncated[0]).name})")
+
+    errors = {}
+    error_names = set()
+    error_hashes = set()
+    if xo.ERROR_DIRECTORY.exists():
+        for subdir in xo.ERROR_DIRECTORY.iterdir():
+            errors[subdir.name] = 0
+            for error_file in subdir.glob("*.xml"):
+                errors[subdir.name] += 1
+                error_names.add(error_file.name)
+                error_hashes.add(xo.calculate_file_hash(error_file))
+
+    # Cada arquivo gerado precisa estar em algum lugar: destino, _ERROS, ainda na
+    # origem, ou ter sido removido com o conteúdo preservado em outra cópia
+    archived_names = {Path(p).name for p in archived_files}
+    archived_keys = {chave for chave, caminho in rows if caminho in archived_files}
+    source_names = {p.name for p in xo.SOURCE_DIRECTORY.rglob("*.xml")}
+    accounting = {"destino": 0, "erros": 0, "origem": 0, "duplicata": 0, "quarentena": 0, "perdidos": 0}
+    lost = []
+    for index, origin in enumerate(producer.origins):
+        name = build_file_name(index + 1)
+        if name in archived_names:
+            accounting["destino"] += 1
+        elif name in error_names:
+            accounting["erros"] += 1
+        elif name in source_names:
+            accounting["origem"] += 1
+        elif origin > 0 and build_chave(origin) in archived_keys:
+            accounting["duplicata"] += 1
+        elif origin < 0 and producer.invalid_hashes.get(-origin) in error_hashes:
+            accounting["quarentena"] += 1
+        else:
+            accounting["perdidos"] += 1
+            lost.append(name)
+    if lost:
+        issues.append(
+            f"{len(lost)} arquivo(s) gerado(s) removido(s) sem nenhuma cópia (ex.: {', '.join(lost[:3])})"
+        )
+
+    return {
+        "notas_no_banco": len(rows),
+        "arquivos_no_destino": len(archived_files),
+        "validos_fora_do_banco": producer.counters["validos"] - len(db_keys),
+        "restantes_na_origem": sum(1 for _ in xo.SOURCE_DIRECTORY.rglob("*.xml")),
+        "ocorrencias_em_quarentena": quarantined,
+        "pasta_erros": errors,
+        "destino_dos_arquivos_gerados": accounting,
+        "arquivos_verificados": len(sample),
+        "problemas": issues,
+    }
+
+def configure(root: Path, args):
+    xo.SOURCE_DIRECTORY = root / "origem"
+    xo.DESTINATION_NETWORK_DIRECTORY = root / "rede" / "ZZZ_XML_BOT"
+    xo.ERROR_DIRECTORY = xo.DESTINATION_NETWORK_DIRECTORY / "_ERROS"
+    xo.DATABASE_FILE = str(root / "dados" / "xml_organizer.db")
+    xo.SHARD_INBOX_DIRECTORY = root / "dados" / "inbox"
+    xo.ARCHIVE_DIRECTORY = root / "dados" / "particoes"
+    xo.MAX_WORKERS = args.workers
+    xo.SCAN_INTERVAL = args.scan_interval
+    xo.FILE_STABLE_SECONDS = args.stable_seconds
+    xo.FILE_RETRY_INTERVAL = args.retry_interval
+
+    xo.SOURCE_DIRECTORY.mkdir(parents=True)
+    xo.DESTINATION_NETWORK_DIRECTORY.mkdir(parents=True)
+    (root / "dados").mkdir()
+
+    # Log do organizer vai para o diretório do teste, não para o log de produção
+    for handler in list(logging.getLogger().handlers):
+        if isinstance(handler, logging.FileHandler):
+            logging.getLogger().removeHandler(handler)
+        elif not args.verbose:
+            handler.setLevel(logging.CRITICAL)
+    file_handler = logging.FileHandler(root / "dados" / "soak.log", encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
+    logging.getLogger().addHandler(file_handler)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Soak test do XML Organizer com drive de rede simulado")
+    parser.add_argument("--duration", type=float, default=600, help="Segundos de carga (ex.: 14400 = 4h)")
+    parser.add_argument("--drain", type=float, default=120, help="Segundos máximos para esvaziar a origem ao final")
+    parser.add_argument("--rate", type=float, default=20, help="Arquivos por segundo gerados na origem")
+    parser.add_argument("--dup-rate", type=float, default=0.1)
+    parser.add_argument("--invalid-rate", type=float, default=0.03)
+    parser.add_argument("--slow-write-rate", type=float, default=0.05)
+    parser.add_argument("--latency-min-ms", type=float, default=5)
+    parser.add_argument("--latency-max-ms", type=float, default=200)
+    parser.add_argument("--eio-rate", type=float, default=0.005, help="Probabilidade de EIO por operação")
+    parser.add_argument("--stall-rate", type=float, default=0.0005, help="Probabilidade de travamento por operação")
+    parser.add_argument("--stall-seconds", type=float, default=10)
+    parser.add_argument("--workers", type=int, default=xo.MAX_WORKERS)
+    parser.add_argument("--scan-interval", type=float, default=5)
+    parser.add_argument("--stable-seconds", type=float, default=5,
+                        help="Deve ser maior que a pausa das gravações lentas (até 3s)")
+    parser.add_argument("--retry-interval", type=float, default=30)
+    parser.add_argument("--prune-after", type=float, default=3600,
+                        help="Segundos até esquecer arquivos gerados que não chegaram ao destino")
+    parser.add_argument("--sample-interval", type=float, default=60, help="Segundos entre amostras de memória")
+    parser.add_argument("--verify-sample", type=int, default=1000, help="XMLs do destino relidos no final (0 = todos)")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Mede o heap alocado pelo organizer com tracemalloc (deixa o processo mais lento)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workdir", type=Path, help="Diretório de trabalho (padrão: temporário, removido ao final)")
+    parser.add_argument("--report", type=Path, help="Grava o relatório em JSON")
+    parser.add_argument("--verbose", action="store_true", help="Mostra os logs do organizer")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    root = Path(args.workdir or tempfile.mkdtemp(prefix="xml_organizer_soak_"))
+    configure(root, args)
+
+    injector = FaultInjector(
+        xo.DESTINATION_NETWORK_DIRECTORY.parent,
+        (args.latency_min_ms, args.latency_max_ms),
+        args.eio_rate, args.stall_rate, args.stall_seconds, args.seed
+    )
+    producer = Producer(xo.SOURCE_DIRECTORY, args.rate, args.dup_rate, args.invalid_rate,
+                        args.slow_write_rate, args.seed)
+
+    print(f"→ Soak test em {root} por {args.duration:.0f}s ({args.rate:g} arq/s)")
+
+    xo.setup_database()
+    xo.migrate_old_database()
+    xo.load_caches()
+
+    if args.trace_memory:
+        tracemalloc.start()
+    injector.on_archived = producer.record_archived
+    injector.install()
+    stop_event = threading.Event()
+    loop = threading.Thread(target=xo.run_processing_loop, args=(stop_event,), daemon=True)
+
+    start = time.time()
+    memory_samples = [sample_memory(0.0, args.trace_memory)]
+    loop.start()
+    producer.start()
+
+    try:
+        next_sample = start + args.sample_interval
+        while time.time() - start < args.duration:
+            time.sleep(min(1, max(0, next_sample - time.time())))
+            if time.time() >= next_sample:
+                producer.prune(args.prune_after)
+                memory_samples.append(sample_memory(time.time() - start, args.trace_memory))
+                next_sample += args.sample_interval
+                print(f"  {time.time() - start:7.0f}s | arquivados: {producer.archived} | "
+                      f"RSS: {memory_samples[-1][1] / 1024:.1f} MB")
+    except KeyboardInterrupt:
+        print("⊗ Interrompido, finalizando com os dados coletados")
+
+    load_seconds = time.time() - start
+    producer.stop_event.set()
+    producer.join()
+
+    drain_start = time.time()
+    while time.time() - drain_start < args.drain and any(xo.SOURCE_DIRECTORY.rglob("*.xml")):
+        time.sleep(1)
+
+    stop_event.set()
+    loop.join(timeout=args.drain)
+    injector.uninstall()
+    elapsed = time.time() - start
+    memory_samples.append(sample_memory(elapsed, args.trace_memory))
+    if args.trace_memory:
+        tracemalloc.stop()
+
+    latencies = list(producer.archive_latencies)
+    # A primeira amostra após o aquecimento é a referência (caches e conexões já criados)
+    baseline = memory_samples[1] if len(memory_samples) > 2 else memory_samples[0]
+    consistency = check_consistency(producer, args.verify_sample, args.seed)
+
+    report = {
+        "duracao_carga_s": round(load_seconds, 1),
+        "duracao_total_s": round(elapsed, 1),
+        "gerados": producer.counters,
+        "falhas_injetadas": injector.counters,
+        "arquivados": producer.archived,
+        "vazao_arq_s": round(producer.archived / elapsed, 2) if elapsed else 0,
+        "tempo_ate_arquivar_s": {
+            "p50": round(percentile(latencies, 50), 3),
+            "p99": round(percentile(latencies, 99), 3),
+            "max": round(max(latencies), 3) if latencies else 0,
+        },
+        "memoria": {
+            "rss_inicial_mb": round(baseline[1] / 1024, 1),
+            "rss_final_mb": round(memory_samples[-1][1] / 1024, 1),
+            "heap_organizer_crescimento_mb": (
+                round((memory_samples[-1][2] - baseline[2]) / 1024 / 1024, 2) if args.trace_memory else None
+            ),
+            "amostras": [(round(t), rss, heap) for t, rss, heap in memory_samples],
+        },
+        "consistencia": consistency,
+    }
+
+    print(json.dumps({k: v for k, v in report.items() if k != "memoria"}, indent=2, ensure_ascii=False))
+    memory = report["memoria"]
+    print(f"Memória: RSS {memory['rss_inicial_mb']} → {memory['rss_final_mb']} MB"
+          + (f" | heap do organizer +{memory['heap_organizer_crescimento_mb']} MB" if args.trace_memory else ""))
+    if args.report:
+        args.report.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+
+    if not args.workdir:
+        shutil.rmtree(root, ignore_errors=True)
+
+    if consistency["problemas"]:
+        print("✗ Inconsistências: " + "; ".join(consistency["problemas"]))
+        return 1
+    print("✓ Banco, destino e arquivos gerados consistentes")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,8 +8,21 @@ import sqlite3
 import re
 import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
+from threading import Lock, Event
 import hashlib
+import stat
+import multiprocessing
+import zlib
+import argparse
+import csv
+import gzip
+import json
+import queue
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs, unquote
 
 # Para WSL
 SOURCE_DIRECTORY = Path("/mnt/c/Automations")
@@ -31,6 +44,67 @@ MAX_WORKERS = 8
 SCAN_INTERVAL = 30
 BATCH_SIZE = 200
 
+# Um arquivo só é processado depois que tamanho, mtime e inode ficam estáveis
+# por FILE_STABLE_SECONDS (evita pegar XMLs ainda sendo gravados pela automação)
+FILE_STABLE_SECONDS = 10
+FILE_RETRY_INTERVAL = 600
+
+NFE_NAMESPACE = 'http://www.portalfiscal.inf.br/nfe'
+
+# Campos extraídos de cada XML: caminho = tags sem namespace, a primeira em qualquer
+# nível do documento e as seguintes como filhos diretos; "@" indica atributo;
+# com vários caminhos, vale o primeiro da lista que existir no XML
+XML_FIELDS = {
+    "chave_acesso": "infNFe@Id",
+    "data_emissao": ("infNFe/ide/dhEmi", "infNFe/ide/dEmi"),
+    "modelo": "infNFe/ide/mod",
+    "cnpj": "infNFe/emit/CNPJ",
+    "nome_empresa": "infNFe/emit/xNome",
+    "serie": "infNFe/ide/serie",
+    "numero": "infNFe/ide/nNF",
+    "valor_total": "infNFe/total/ICMSTot/vNF",
+    "destinatario_documento": ("infNFe/dest/CNPJ", "infNFe/dest/CPF", "infNFe/dest/idEstrangeiro"),
+    "protocolo_status": "protNFe/infProt/cStat",
+}
+
+# Campos de XML_FIELDS gravados em colunas próprias de nota_fiscal
+NOTA_EXTRA_COLUMNS = {
+    "serie": "TEXT",
+    "numero": "TEXT",
+    "valor_total": "REAL",
+    "destinatario_documento": "TEXT",
+    "protocolo_status": "TEXT",
+}
+
+# Modo multiprocesso: com SHARD_COUNT > 1 cada shard roda em um processo próprio,
+# reivindicando arquivos por rename atômico para sua caixa de entrada
+SHARD_COUNT = 1
+SHARD_INBOX_DIRECTORY = Path(os.path.dirname(DATABASE_FILE)) / "inbox"
+SHARD_RESTART_DELAY = 10
+
+# Partições por ano de emissão: anos fechados saem do banco principal para arquivos
+# somente leitura (comando "archive"), mantendo apenas ARCHIVE_HOT_YEARS anos recentes
+ARCHIVE_DIRECTORY = Path(os.path.dirname(DATABASE_FILE)) / "particoes"
+ARCHIVE_HOT_YEARS = 2
+ARCHIVE_BATCH_SIZE = 5000
+ARCHIVE_FILTER_BITS_PER_KEY = 10
+ARCHIVE_FILTER_HASHES = 7
+ARCHIVE_CHECK_INTERVAL = 30
+# Partições mantidas anexadas por conexão de consulta (o SQLite aceita no máximo 10)
+ARCHIVE_ATTACHED_MAX = 8
+
+# Exportação para BI (comando "export")
+EXPORT_DIRECTORY = Path(os.path.dirname(DATABASE_FILE)) / "export"
+EXPORT_FETCH_SIZE = 5000
+
+# Serviço local de consulta (comando "serve")
+LOOKUP_HOST = "127.0.0.1"
+LOOKUP_PORT = 8750
+LOOKUP_POOL_SIZE = 8
+LOOKUP_CACHE_SIZE = 10000
+LOOKUP_CACHE_TTL = 60
+LOOKUP_MAX_RESULTS = 500
+
 os.makedirs(os.path.dirname(DATABASE_FILE), exist_ok=True)
 
 logging.basicConfig(
@@ -48,12 +122,22 @@ company_cache = {}
 cache_lock = Lock()
 processed_hashes = set()
 processed_keys = set()
+quarantined_hashes = {}
+file_fingerprints = {}
+archive_filters = {}
+archive_signature = None
 
 def setup_database():
     try:
         conn = sqlite3.connect(DATABASE_FILE)
         cursor = conn.cursor()
         
+        # WAL permite leitores e múltiplos processos sem bloquear o escritor
+        cursor.execute('PRAGMA journal_mode=WAL')
+        journal_mode = cursor.fetchone()[0]
+        if journal_mode.lower() != 'wal':
+            logging.warning(f"Banco em modo {journal_mode} (WAL indisponível)")
+        
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS empresa (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -64,7 +148,7 @@ def setup_database():
         )
         ''')
 
-        cursor.execute('''
+        cursor.execute(f'''
         CREATE TABLE IF NOT EXISTS nota_fiscal (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             chave_acesso TEXT NOT NULL UNIQUE,
@@ -76,16 +160,43 @@ def setup_database():
             caminho_arquivo TEXT NOT NULL,
             status TEXT DEFAULT 'PROCESSADO',
             created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            {''.join(f'{column} {column_type},' for column, column_type in NOTA_EXTRA_COLUMNS.items())}
             FOREIGN KEY (empresa_id) REFERENCES empresa (id)
         )
         ''')
         
+        cursor.execute("PRAGMA table_info(nota_fiscal)")
+        existing_columns = {row[1] for row in cursor.fetchall()}
+        for column, column_type in NOTA_EXTRA_COLUMNS.items():
+            if column not in existing_columns:
+                cursor.execute(f"ALTER TABLE nota_fiscal ADD COLUMN {column} {column_type}")
+                logging.info(f"  + Coluna nota_fiscal.{column} adicionada")
+        
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_chave_acesso ON nota_fiscal(chave_acesso)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_hash_arquivo ON nota_fiscal(hash_arquivo)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_empresa_cnpj ON empresa(cnpj)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_empresa_id ON nota_fiscal(empresa_id)')
+        # (empresa_id, data_emissao) atende tanto empresa_id isolado quanto CNPJ + período
+        cursor.execute('DROP INDEX IF EXISTS idx_empresa_id')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_empresa_data ON nota_fiscal(empresa_id, data_emissao)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_empresa_nome ON empresa(nome)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_data_emissao ON nota_fiscal(data_emissao)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_tipo_documento ON nota_fiscal(tipo_documento)')
+        # Notas inseridas com a movimentação para o destino ainda em andamento (poucas linhas)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_nota_movendo ON nota_fiscal(id) WHERE status = 'MOVENDO'")
+        
+        # Quarentena: conteúdos que já falharam, reconhecidos pelo hash sem novo parse
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS arquivo_invalido (
+            hash_arquivo TEXT NOT NULL,
+            motivo TEXT NOT NULL,
+            ocorrencias INTEGER NOT NULL DEFAULT 1,
+            ultimo_nome TEXT,
+            arquivo_erro TEXT,
+            primeiro_visto TEXT DEFAULT CURRENT_TIMESTAMP,
+            ultimo_visto TEXT DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (hash_arquivo, motivo)
+        )
+        ''')
         
         conn.commit()
         conn.close()
@@ -171,8 +282,8 @@ def migrate_old_database():
     except Exception as e:
         logging.warning(f"Aviso na migração: {e}")
 
-def load_caches():
-    global company_cache, processed_hashes, processed_keys
+def load_caches(include_notes: bool = True):
+    global company_cache, processed_hashes, processed_keys, quarantined_hashes
     
     try:
         conn = sqlite3.connect(DATABASE_FILE)
@@ -182,13 +293,24 @@ def load_caches():
         for cnpj, empresa_id, nome in cursor.fetchall():
             company_cache[cnpj] = {"id": empresa_id, "nome": nome}
         
-        cursor.execute("SELECT hash_arquivo, chave_acesso FROM nota_fiscal")
-        for hash_arq, chave in cursor.fetchall():
-            processed_hashes.add(hash_arq)
-            processed_keys.add(chave)
+        # Nos shards as duplicatas são resolvidas pelas constraints UNIQUE do banco,
+        # já que um set em memória não enxerga o que os outros processos inseriram
+        if include_notes:
+            cursor.execute("SELECT hash_arquivo, chave_acesso FROM nota_fiscal")
+            for hash_arq, chave in cursor.fetchall():
+                processed_hashes.add(hash_arq)
+                processed_keys.add(chave)
+        
+        cursor.execute("SELECT hash_arquivo, motivo, arquivo_erro FROM arquivo_invalido")
+        for hash_arq, motivo, arquivo_erro in cursor.fetchall():
+            quarantined_hashes[hash_arq] = (motivo, arquivo_erro)
         
         conn.close()
-        logging.info(f"✓ Cache: {len(company_cache)} empresas, {len(processed_hashes)} registros")
+        refresh_archive_filters()
+        logging.info(
+            f"✓ Cache: {len(company_cache)} empresas, {len(processed_hashes)} registros, "
+            f"{len(quarantined_hashes)} em quarentena, {len(archive_filters)} partição(ões) arquivada(s)"
+        )
     except Exception as e:
         logging.error(f"Erro ao carregar cache: {e}")
 
@@ -255,100 +377,93 @@ def get_or_create_company(cnpj: str, nome_xml: str) -> int:
                     conn.commit()
             else:
                 cursor.execute(
-                    "INSERT INTO empresa (cnpj, nome) VALUES (?, ?)",
+                    "INSERT OR IGNORE INTO empresa (cnpj, nome) VALUES (?, ?)",
                     (cnpj, nome_padronizado)
                 )
                 conn.commit()
-                company_id = cursor.lastrowid
-                logging.info(f"  + Nova empresa: {nome_padronizado} ({cnpj})")
+                
+                if cursor.rowcount > 0:
+                    company_id = cursor.lastrowid
+                    logging.info(f"  + Nova empresa: {nome_padronizado} ({cnpj})")
+                else:
+                    # Outro shard cadastrou o CNPJ entre o SELECT e o INSERT
+                    cursor.execute("SELECT id FROM empresa WHERE cnpj = ?", (cnpj,))
+                    company_id = cursor.fetchone()[0]
             
             conn.close()
             
             company_cache[cnpj] = {"id": company_id, "nome": nome_padronizado}
             return company_id
 
-def get_xml_info(xml_file: Path) -> dict:
-    namespaces = [
-        {'nfe': 'http://www.portalfiscal.inf.br/nfe'},
-        {},
-    ]
-    
-    try:
-        tree = ET.parse(xml_file)
-        root = tree.getroot()
-
-        infNFe = None
-        for ns in namespaces:
-            infNFe = root.find('.//nfe:infNFe', ns) if ns else root.find('.//infNFe')
-            if infNFe is not None:
-                break
-        
-        if infNFe is None:
-            for elem in root.iter():
-                if elem.tag.endswith('infNFe'):
-                    infNFe = elem
-                    break
-        
-        if infNFe is None:
-            return None
+def compile_extraction_plan(fields: dict) -> dict:
+    # Cada caminho vira uma âncora (primeira tag, localizada uma vez por documento)
+    # e um caminho relativo já montado para find(), com e sem namespace: o parse
+    # e as buscas ficam em C e só os elementos dos campos são visitados
+    anchors = set()
+    plan_fields = []
+    for field, paths in fields.items():
+        if isinstance(paths, str):
+            paths = (paths,)
+        candidates = []
+        for path in paths:
+            path, _, attribute = path.partition("@")
+            anchor, *children = path.split("/")
+            anchors.add(anchor)
+            candidates.append((
+                anchor,
+                "/".join(f"{{{NFE_NAMESPACE}}}{tag}" for tag in children) or None,
+                "/".join(children) or None,
+                attribute or None,
+            ))
+        plan_fields.append((field, tuple(candidates)))
+    return {"anchors": tuple(sorted(anchors)), "fields": tuple(plan_fields)}
 
-        chave_acesso = infNFe.get('Id', '').replace('NFe', '').replace('nfe', '')
+XML_EXTRACTION_PLAN = compile_extraction_plan(XML_FIELDS)
 
-        ide = None
-        emit = None
-        for ns in namespaces:
-            if ns:
-                ide = infNFe.find('nfe:ide', ns)
-                emit = infNFe.find('nfe:emit', ns)
-            else:
-                ide = infNFe.find('ide')
-                emit = infNFe.find('emit')
-            if ide is not None and emit is not None:
+def extract_fields(xml_file: Path, plan: dict) -> dict:
+    root = ET.parse(xml_file).getroot()
+    
+    anchors = {}
+    for tag in plan["anchors"]:
+        elem = next(root.iter(f"{{{NFE_NAMESPACE}}}{tag}"), None)
+        if elem is None:
+            elem = next(root.iter(tag), None)
+        if elem is not None:
+            anchors[tag] = elem
+    
+    found = {}
+    for field, candidates in plan["fields"]:
+        for anchor, namespaced_path, plain_path, attribute in candidates:
+            elem = anchors.get(anchor)
+            if elem is not None and namespaced_path:
+                elem = elem.find(namespaced_path if elem.tag[0] == "{" else plain_path)
+            if elem is None:
+                continue
+            value = elem.get(attribute) if attribute else elem.text
+            if value is not None:
+                found[field] = value
                 break
+    
+    return found
 
-        if ide is None or emit is None:
-            return None
-
-        data_emissao_str = None
-        for tag_name in ['dhEmi', 'dEmi']:
-            for ns in namespaces:
-                elem = ide.find(f'nfe:{tag_name}', ns) if ns else ide.find(tag_name)
-                if elem is not None:
-                    data_emissao_str = elem.text.split('T')[0] if 'T' in elem.text else elem.text
-                    break
-            if data_emissao_str:
-                break
+def get_xml_info(xml_file: Path) -> dict:
+    try:
+        fields = extract_fields(xml_file, XML_EXTRACTION_PLAN)
         
-        if not data_emissao_str:
+        data_emissao = fields.get("data_emissao")
+        cnpj = fields.get("cnpj")
+        nome_empresa = fields.get("nome_empresa")
+        
+        if not data_emissao or not cnpj or not nome_empresa:
             return None
-            
-        data_emissao_dt = datetime.strptime(data_emissao_str, '%Y-%m-%d')
-
-        modelo = None
-        for ns in namespaces:
-            mod_elem = ide.find('nfe:mod', ns) if ns else ide.find('mod')
-            if mod_elem is not None:
-                modelo = mod_elem.text
-                break
         
+        chave_acesso = fields.get("chave_acesso", "").replace('NFe', '').replace('nfe', '')
+        data_emissao_dt = datetime.strptime(data_emissao.split('T')[0], '%Y-%m-%d')
+        
+        modelo = fields.get("modelo")
         tipo_documento = 'NFE' if modelo == '55' else 'NFCE' if modelo == '65' else f"MOD{modelo}"
-
-        cnpj = None
-        nome_empresa = None
-        for ns in namespaces:
-            cnpj_elem = emit.find('nfe:CNPJ', ns) if ns else emit.find('CNPJ')
-            nome_elem = emit.find('nfe:xNome', ns) if ns else emit.find('xNome')
-            if cnpj_elem is not None:
-                cnpj = cnpj_elem.text
-            if nome_elem is not None:
-                nome_empresa = nome_elem.text
-            if cnpj and nome_empresa:
-                break
-
-        if not cnpj or not nome_empresa:
-            return None
-
-        return {
+        
+        info = {
             "data_processamento": datetime.now().strftime('%Y-%m-%d'),
             "data_emissao": data_emissao_dt.strftime('%Y-%m-%d'),
             "chave_acesso": chave_acesso,
@@ -360,35 +475,131 @@ def get_xml_info(xml_file: Path) -> dict:
             "mes_ano_emissao": data_emissao_dt.strftime('%m-%Y'),
             "dia_emissao": data_emissao_dt.strftime('%d')
         }
+        
+        for column, column_type in NOTA_EXTRA_COLUMNS.items():
+            value = fields.get(column)
+            if value is not None and column_type == "REAL":
+                try:
+                    value = float(value)
+                except ValueError:
+                    value = None
+            info[column] = value
+        
+        return info
 
     except Exception:
         return None
 
+NOTA_INSERT_COLUMNS = (
+    "chave_acesso", "hash_arquivo", "empresa_id", "data_processamento",
+    "data_emissao", "tipo_documento", "caminho_arquivo", "status"
+) + tuple(NOTA_EXTRA_COLUMNS)
+
+NOTA_INSERT_SQL = (
+    f"INSERT INTO nota_fiscal ({', '.join(NOTA_INSERT_COLUMNS)}) "
+    f"VALUES ({', '.join('?' for _ in NOTA_INSERT_COLUMNS)})"
+)
+
 def insert_nota_fiscal(data: tuple) -> bool:
+    # False só para duplicata (constraint UNIQUE); outros erros do banco (lock,
+    # I/O) sobem para o chamador, que mantém o arquivo para nova tentativa
     try:
         with db_lock:
             conn = sqlite3.connect(DATABASE_FILE, timeout=20)
-            cursor = conn.cursor()
+            try:
+                cursor = conn.cursor()
+                
+                cursor.execute(NOTA_INSERT_SQL, data)
+                
+                conn.commit()
+                return cursor.rowcount > 0
+            finally:
+                # Fecha também no IntegrityError: a transação aberta seguraria
+                # o lock de escrita e travaria os outros processos
+                conn.close()
             
-            cursor.execute(
-                '''INSERT INTO nota_fiscal 
-                (chave_acesso, hash_arquivo, empresa_id, data_processamento, 
-                 data_emissao, tipo_documento, caminho_arquivo)
-                VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                data
-            )
+    except sqlite3.IntegrityError:
+        return False
+
+def set_nota_processed(chave_acesso: str):
+    # Só depois do arquivo no destino a nota passa a ser exportada; se falhar,
+    # recover_pending_moves resolve na próxima inicialização
+    try:
+        with db_lock:
+            conn = sqlite3.connect(DATABASE_FILE, timeout=20)
+            try:
+                conn.execute(
+                    "UPDATE nota_fiscal SET status = 'PROCESSADO' WHERE chave_acesso = ?",
+                    (chave_acesso,)
+                )
+                conn.commit()
+            finally:
+                conn.close()
+    except Exception as e:
+        logging.error(f"Erro ao concluir nota {chave_acesso}: {e}")
+
+def recover_pending_moves():
+    # Notas que ficaram 'MOVENDO' por uma queda entre a inserção e a movimentação:
+    # com o arquivo no destino a nota é concluída; sem ele o registro é removido
+    # e o XML, ainda na origem, é processado de novo
+    try:
+        conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, caminho_arquivo FROM nota_fiscal WHERE status = 'MOVENDO'")
+            pending = cursor.fetchall()
             
+            completed = 0
+            for nota_id, caminho in pending:
+                if Path(caminho).exists():
+                    cursor.execute("UPDATE nota_fiscal SET status = 'PROCESSADO' WHERE id = ?", (nota_id,))
+                    completed += 1
+                else:
+                    cursor.execute("DELETE FROM nota_fiscal WHERE id = ?", (nota_id,))
             conn.commit()
-            inserted = cursor.rowcount > 0
+        finally:
             conn.close()
-            
-            return inserted
-            
-    except sqlite3.IntegrityError:
-        return False
+        
+        if pending:
+            logging.info(
+                f"↻ {len(pending)} nota(s) interrompida(s) na movimentação: "
+                f"{completed} concluída(s), {len(pending) - completed} removida(s) para reprocessar"
+            )
     except Exception as e:
-        logging.error(f"Erro ao inserir nota: {e}")
-        return False
+        logging.warning(f"Aviso ao recuperar notas em movimentação: {e}")
+
+def record_invalid_file(file_hash: str, reason: str, file_name: str, error_copy: str = None):
+    # error_copy: nome da cópia que acabou de ser gravada em _ERROS/<motivo>;
+    # None mantém a cópia registrada anteriormente
+    try:
+        with db_lock:
+            conn = sqlite3.connect(DATABASE_FILE, timeout=20)
+            try:
+                # INSERT OR IGNORE + UPDATE em vez de ON CONFLICT DO UPDATE (SQLite 3.24+)
+                cursor = conn.execute(
+                    '''INSERT OR IGNORE INTO arquivo_invalido (hash_arquivo, motivo, ultimo_nome, arquivo_erro)
+                    VALUES (?, ?, ?, ?)''',
+                    (file_hash, reason, file_name, error_copy)
+                )
+                if cursor.rowcount == 0:
+                    conn.execute(
+                        '''UPDATE arquivo_invalido SET
+                            ocorrencias = ocorrencias + 1,
+                            ultimo_nome = ?,
+                            arquivo_erro = COALESCE(?, arquivo_erro),
+                            ultimo_visto = CURRENT_TIMESTAMP
+                        WHERE hash_arquivo = ? AND motivo = ?''',
+                        (file_name, error_copy, file_hash, reason)
+                    )
+                conn.commit()
+            finally:
+                conn.close()
+        
+        if error_copy or file_hash not in quarantined_hashes:
+            quarantined_hashes[file_hash] = (reason, error_copy)
+    
+    except Exception as e:
+        logging.error(f"Erro ao registrar quarentena de {file_name}: {e}")
 
 def move_file_to_destination(xml_file: Path, info: dict) -> bool:
     try:
@@ -415,19 +626,34 @@ def move_file_to_destination(xml_file: Path, info: dict) -> bool:
         logging.error(f"Erro ao mover {xml_file.name}: {e}")
         return False
 
-def move_to_error_folder(xml_file: Path, reason: str = "erro_processamento"):
+def get_quarantine_name(xml_file: Path, file_hash: str) -> str:
+    # O hash no nome impede que outro arquivo de mesmo nome sobrescreva a cópia em
+    # quarentena: basta ela existir para saber que o conteúdo está preservado
+    return f"{xml_file.stem}_{file_hash}{xml_file.suffix}"
+
+def has_error_copy(reason: str, error_copy: str) -> bool:
+    if not error_copy:
+        return False
+    try:
+        return (ERROR_DIRECTORY / reason / error_copy).exists()
+    except Exception:
+        return False
+
+def move_to_error_folder(xml_file: Path, reason: str = "erro_processamento", file_name: str = None) -> bool:
     try:
         ERROR_DIRECTORY.mkdir(parents=True, exist_ok=True)
         error_subdir = ERROR_DIRECTORY / reason
         error_subdir.mkdir(exist_ok=True)
         
-        destination = error_subdir / xml_file.name
+        destination = error_subdir / (file_name or xml_file.name)
         if destination.exists():
             destination.unlink()
         shutil.move(str(xml_file), str(destination))
+        return True
         
     except Exception as e:
         logging.error(f"Erro ao mover para pasta de erros {xml_file.name}: {e}")
+        return False
 
 def process_single_file(xml_file: Path) -> dict:
     result = {"file": xml_file.name, "status": "erro", "reason": ""}
@@ -439,18 +665,39 @@ def process_single_file(xml_file: Path) -> dict:
             move_to_error_folder(xml_file, "erro_leitura")
             return result
         
-        if file_hash in processed_hashes:
+        if file_hash in processed_hashes or is_archived("hash", file_hash):
             result["status"] = "duplicado_hash"
             xml_file.unlink()
             return result
         
+        # Conteúdo já conhecido como inválido: se a cópia em _ERROS ainda existe,
+        # basta contar a ocorrência e remover localmente; senão grava uma nova
+        quarantined = quarantined_hashes.get(file_hash)
+        if quarantined:
+            quarantine_reason, error_copy = quarantined
+            result["reason"] = quarantine_reason
+            if has_error_copy(quarantine_reason, error_copy):
+                result["status"] = "quarentena"
+                record_invalid_file(file_hash, quarantine_reason, xml_file.name)
+                xml_file.unlink()
+            else:
+                error_copy = get_quarantine_name(xml_file, file_hash)
+                if move_to_error_folder(xml_file, quarantine_reason, error_copy):
+                    result["status"] = "quarentena"
+                    record_invalid_file(file_hash, quarantine_reason, xml_file.name, error_copy)
+            return result
+        
         info = get_xml_info(xml_file)
         if not info:
             result["reason"] = "xml_invalido"
-            move_to_error_folder(xml_file, "xml_invalido")
+            # Só entra em quarentena com a cópia garantida em _ERROS: se a movimentação
+            # falhar o arquivo fica na origem e é tentado de novo
+            error_copy = get_quarantine_name(xml_file, file_hash)
+            if move_to_error_folder(xml_file, "xml_invalido", error_copy):
+                record_invalid_file(file_hash, "xml_invalido", xml_file.name, error_copy)
             return result
 
-        if info["chave_acesso"] in processed_keys:
+        if info["chave_acesso"] in processed_keys or is_archived("chave", info["chave_acesso"]):
             result["status"] = "duplicado_chave"
             xml_file.unlink()
             return result
@@ -477,10 +724,20 @@ def process_single_file(xml_file: Path) -> dict:
             info["data_processamento"],
             info["data_emissao"],
             info["tipo_documento"],
-            str(destination_path)
-        )
+            str(destination_path),
+            "MOVENDO"
+        ) + tuple(info[column] for column in NOTA_EXTRA_COLUMNS)
         
-        if not insert_nota_fiscal(nota_data):
+        try:
+            inserted = insert_nota_fiscal(nota_data)
+        except sqlite3.Error as e:
+            # Banco travado ou indisponível (lock de outro shard, "archive", I/O): não é
+            # duplicata, o arquivo fica na origem ou na inbox do shard para nova tentativa
+            logging.error(f"Erro ao inserir nota {xml_file.name}: {e}")
+            result["reason"] = "erro_banco"
+            return result
+        
+        if not inserted:
             result["status"] = "duplicado_banco"
             xml_file.unlink()
             return result
@@ -489,6 +746,7 @@ def process_single_file(xml_file: Path) -> dict:
         processed_keys.add(info["chave_acesso"])
         
         if move_file_to_destination(xml_file, info):
+            set_nota_processed(info["chave_acesso"])
             result["status"] = "sucesso"
             result["info"] = info
         else:
@@ -516,6 +774,7 @@ def process_batch(xml_files: list) -> dict:
     stats = {
         "sucesso": 0, 
         "duplicado": 0,
+        "quarentena": 0,
         "erro": 0
     }
     
@@ -530,6 +789,8 @@ def process_batch(xml_files: list) -> dict:
                     stats["sucesso"] += 1
                 elif "duplicado" in result["status"]:
                     stats["duplicado"] += 1
+                elif result["status"] == "quarentena":
+                    stats["quarentena"] += 1
                 else:
                     stats["erro"] += 1
                     
@@ -539,21 +800,74 @@ def process_batch(xml_files: list) -> dict:
     
     return stats
 
-def scan_and_process():
+def get_file_fingerprint(file_path: Path) -> tuple:
+    try:
+        st = file_path.stat()
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+def select_ready_files(xml_files: list) -> tuple:
+    now = time.time()
+    ready = []
+    pending = 0
+    seen = set()
+    
+    for xml_file in xml_files:
+        key = str(xml_file)
+        seen.add(key)
+        
+        fingerprint = get_file_fingerprint(xml_file)
+        if fingerprint is None:
+            continue
+        
+        entry = file_fingerprints.get(key)
+        if entry is None or entry["fingerprint"] != fingerprint:
+            entry = {"fingerprint": fingerprint, "stable_since": now, "attempted_at": None}
+            file_fingerprints[key] = entry
+        
+        # Já tentado e ainda na origem (ex.: falha ao mover): não reabre nem recalcula o hash
+        # até o arquivo mudar ou o intervalo de nova tentativa passar
+        if entry["attempted_at"] is not None and now - entry["attempted_at"] < FILE_RETRY_INTERVAL:
+            continue
+        
+        if now - entry["stable_since"] >= FILE_STABLE_SECONDS:
+            ready.append(xml_file)
+        else:
+            pending += 1
+    
+    for key in [k for k in file_fingerprints if k not in seen]:
+        del file_fingerprints[key]
+    
+    return ready, pending
+
+def mark_files_attempted(xml_files: list):
+    now = time.time()
+    for xml_file in xml_files:
+        entry = file_fingerprints.get(str(xml_file))
+        if entry is not None:
+            entry["attempted_at"] = now
+
+def scan_and_process() -> int:
     if not SOURCE_DIRECTORY.exists():
         logging.error(f"Diretório de origem não encontrado: {SOURCE_DIRECTORY}")
-        return
+        return 0
     
-    xml_files = list(SOURCE_DIRECTORY.rglob("*.xml"))
+    refresh_archive_filters()
+    xml_files, pending = select_ready_files(list(SOURCE_DIRECTORY.rglob("*.xml")))
     
-    if not xml_files:
-        return
+    if xml_files:
+        process_files(xml_files)
+        mark_files_attempted(xml_files)
     
+    return pending
+
+def process_files(xml_files: list):
     total = len(xml_files)
     logging.info(f"→ {total} arquivo(s) encontrado(s)")
     
     start_time = time.time()
-    total_stats = {"sucesso": 0, "duplicado": 0, "erro": 0}
+    total_stats = {"sucesso": 0, "duplicado": 0, "quarentena": 0, "erro": 0}
     batch_num = 0
     
     for i in range(0, total, BATCH_SIZE):
@@ -572,7 +886,7 @@ def scan_and_process():
         
         logging.info(
             f"✓ Lote {batch_num}/{total_batches}: {stats['sucesso']} ok | "
-            f"{stats['duplicado']} dup | {stats['erro']} erro | "
+            f"{stats['duplicado']} dup | {stats['quarentena']} quar | {stats['erro']} erro | "
             f"{processed}/{total} ({rate:.1f} arq/s)"
         )
     
@@ -580,10 +894,788 @@ def scan_and_process():
     if sum(total_stats.values()) > 0:
         logging.info(
             f"✓ CONCLUÍDO: {total_stats['sucesso']} novos | "
-            f"{total_stats['duplicado']} duplicados | {total_stats['erro']} erros | "
+            f"{total_stats['duplicado']} duplicados | {total_stats['quarentena']} em quarentena | "
+            f"{total_stats['erro']} erros | "
             f"Tempo: {elapsed:.1f}s | Taxa: {total/elapsed:.1f} arq/s"
         )
 
+def get_shard_inbox(shard_id: int) -> Path:
+    return SHARD_INBOX_DIRECTORY / f"shard_{shard_id}"
+
+def claim_files(shard_id: int, shard_count: int) -> tuple:
+    inbox = get_shard_inbox(shard_id)
+    inbox.mkdir(parents=True, exist_ok=True)
+    claimed = 0
+    
+    # Particiona pelo caminho para que os shards não disputem os mesmos arquivos;
+    # o rename continua sendo a garantia de posse caso dois processos coincidam
+    candidates = [
+        xml_file for xml_file in SOURCE_DIRECTORY.rglob("*.xml")
+        if zlib.crc32(str(xml_file).encode('utf-8')) % shard_count == shard_id
+    ]
+    ready, pending = select_ready_files(candidates)
+    
+    for xml_file in ready:
+        target = inbox / xml_file.name
+        if target.exists():
+            continue
+        
+        try:
+            os.rename(xml_file, target)
+            claimed += 1
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            logging.warning(f"Falha ao reivindicar {xml_file.name}: {e}")
+    
+    return claimed, pending
+
+def requeue_inbox(inbox: Path) -> int:
+    if not inbox.exists():
+        return 0
+    
+    requeued = 0
+    for xml_file in inbox.glob("*.xml"):
+        target = SOURCE_DIRECTORY / xml_file.name
+        if target.exists():
+            continue
+        try:
+            os.rename(xml_file, target)
+            requeued += 1
+        except OSError as e:
+            logging.warning(f"Falha ao devolver {xml_file.name}: {e}")
+    
+    return requeued
+
+def requeue_orphan_inboxes(active_shards: int):
+    if not SHARD_INBOX_DIRECTORY.exists():
+        return
+    
+    for inbox in SHARD_INBOX_DIRECTORY.glob("shard_*"):
+        try:
+            shard_id = int(inbox.name.split("_", 1)[1])
+        except ValueError:
+            continue
+        if shard_id >= active_shards:
+            requeued = requeue_inbox(inbox)
+            if requeued:
+                logging.info(f"↻ {requeued} arquivo(s) devolvido(s) do {inbox.name}")
+
+def shard_worker(shard_id: int, shard_count: int):
+    formatter = logging.Formatter(
+        f'%(asctime)s [%(levelname)s] [shard {shard_id}] %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(formatter)
+    
+    logging.info(f"→ Shard iniciado (pid {os.getpid()})")
+    load_caches(include_notes=False)
+    inbox = get_shard_inbox(shard_id)
+    
+    while True:
+        try:
+            pending = 0
+            refresh_archive_filters()
+            if SOURCE_DIRECTORY.exists():
+                _, pending = claim_files(shard_id, shard_count)
+            
+            # Inclui arquivos reivindicados antes de um crash
+            xml_files = list(inbox.glob("*.xml"))
+            if xml_files:
+                process_files(xml_files)
+            
+            time.sleep(min(SCAN_INTERVAL, FILE_STABLE_SECONDS) if pending else SCAN_INTERVAL)
+        
+        except KeyboardInterrupt:
+            break
+        except Exception as e:
+            logging.error(f"✗ Erro no shard: {e}")
+            time.sleep(10)
+
+def start_shard(shard_id: int) -> multiprocessing.Process:
+    process = multiprocessing.Process(
+        target=shard_worker,
+        args=(shard_id, SHARD_COUNT),
+        name=f"xml-organizer-shard-{shard_id}"
+    )
+    process.start()
+    return process
+
+def run_supervisor():
+    requeue_orphan_inboxes(SHARD_COUNT)
+    
+    processes = {}
+    started_at = {}
+    for shard_id in range(SHARD_COUNT):
+        processes[shard_id] = start_shard(shard_id)
+        started_at[shard_id] = time.time()
+    
+    logging.info(f"✓ {SHARD_COUNT} shards iniciados")
+    
+    try:
+        while True:
+            time.sleep(5)
+            
+            for shard_id, process in processes.items():
+                if process.is_alive():
+                    continue
+                if time.time() - started_at[shard_id] < SHARD_RESTART_DELAY:
+                    continue
+                
+                logging.warning(f"✗ Shard {shard_id} finalizou (exit {process.exitcode}), reiniciando")
+                requeued = requeue_inbox(get_shard_inbox(shard_id))
+                if requeued:
+                    logging.info(f"↻ {requeued} arquivo(s) do shard {shard_id} devolvido(s) à origem")
+                
+                processes[shard_id] = start_shard(shard_id)
+                started_at[shard_id] = time.time()
+    
+    except KeyboardInterrupt:
+        logging.info("\n⊗ Finalizando shards por solicitação do usuário")
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join(timeout=30)
+
+class PartitionFilter:
+    # Filtro de Bloom: ~ARCHIVE_FILTER_BITS_PER_KEY bits por chave em vez de um set de strings;
+    # um positivo é confirmado no arquivo da partição, um negativo é definitivo
+    def __init__(self, num_bits: int, num_hashes: int, data: bytearray = None):
+        self.num_bits = max(num_bits, 64)
+        self.num_hashes = num_hashes
+        self.data = data if data is not None else bytearray((self.num_bits + 7) // 8)
+    
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+    
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self.data[pos >> 3] |= 1 << (pos & 7)
+    
+    def __contains__(self, key: str) -> bool:
+        return all(self.data[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+def readonly_uri(db_path) -> str:
+    return f"{Path(db_path).resolve().as_uri()}?mode=ro"
+
+def get_archive_path(year: int) -> Path:
+    return ARCHIVE_DIRECTORY / f"xml_organizer_{year}.db"
+
+def list_archives() -> dict:
+    archives = {}
+    if ARCHIVE_DIRECTORY.exists():
+        for path in ARCHIVE_DIRECTORY.glob("xml_organizer_*.db"):
+            try:
+                archives[int(path.stem.rsplit("_", 1)[1])] = path
+            except ValueError:
+                continue
+    return dict(sorted(archives.items()))
+
+def get_archive_signature() -> tuple:
+    signature = []
+    for year, path in list_archives().items():
+        try:
+            signature.append((year, path.stat().st_mtime_ns))
+        except OSError:
+            continue
+    return tuple(signature)
+
+def refresh_archive_filters():
+    global archive_filters, archive_signature
+    
+    signature = get_archive_signature()
+    if signature == archive_signature:
+        return
+    
+    filters = {}
+    for year, path in list_archives().items():
+        try:
+            conn = sqlite3.connect(readonly_uri(path), uri=True, timeout=10)
+            try:
+                row = conn.execute("SELECT num_bits, num_hashes, dados FROM filtro_dedup").fetchone()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logging.warning(f"Partição {year} ignorada: {e}")
+            continue
+        if row:
+            filters[year] = PartitionFilter(row[0], row[1], bytearray(row[2]))
+    
+    archive_filters = filters
+    archive_signature = signature
+
+def is_archived(kind: str, value: str) -> bool:
+    key = f"{kind}:{value}"
+    column = "hash_arquivo" if kind == "hash" else "chave_acesso"
+    
+    for year, partition_filter in archive_filters.items():
+        if key not in partition_filter:
+            continue
+        
+        conn = sqlite3.connect(readonly_uri(get_archive_path(year)), uri=True, timeout=10)
+        try:
+            found = conn.execute(
+                f"SELECT 1 FROM nota_fiscal WHERE {column} = ? LIMIT 1", (value,)
+            ).fetchone() is not None
+        finally:
+            conn.close()
+        if found:
+            return True
+    
+    return False
+
+def archive_year(year: int) -> int:
+    path = get_archive_path(year)
+    if path.exists():
+        # Ano reaberto por notas emitidas nele que chegaram depois do arquivamento
+        os.chmod(path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+    
+    inicio, fim = f"{year}-01-01", f"{year}-12-31"
+    conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("ATTACH DATABASE ? AS arq", (str(path),))
+        
+        cursor.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = 'nota_fiscal'")
+        ddl = re.sub(r'^CREATE TABLE\s+"?nota_fiscal"?', 'CREATE TABLE IF NOT EXISTS arq.nota_fiscal',
+                     cursor.fetchone()[0], count=1)
+        cursor.execute(ddl)
+        
+        cursor.execute("PRAGMA main.table_info(nota_fiscal)")
+        main_columns = [(row[1], row[2]) for row in cursor.fetchall()]
+        cursor.execute("PRAGMA arq.table_info(nota_fiscal)")
+        archive_columns = {row[1] for row in cursor.fetchall()}
+        for column, column_type in main_columns:
+            if column not in archive_columns:
+                cursor.execute(f"ALTER TABLE arq.nota_fiscal ADD COLUMN {column} {column_type}")
+        
+        cursor.execute('CREATE INDEX IF NOT EXISTS arq.idx_empresa_data ON nota_fiscal(empresa_id, data_emissao)')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS arq.filtro_dedup (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            num_bits INTEGER NOT NULL,
+            num_hashes INTEGER NOT NULL,
+            dados BLOB NOT NULL
+        )
+        ''')
+        
+        # 1) copia para a partição e confirma antes de apagar qualquer coisa do banco principal
+        columns = ", ".join(column for column, _ in main_columns)
+        cursor.execute(
+            f"INSERT OR IGNORE INTO arq.nota_fiscal ({columns}) "
+            f"SELECT {columns} FROM main.nota_fiscal WHERE data_emissao BETWEEN ? AND ? AND status != 'MOVENDO'",
+            (inicio, fim)
+        )
+        conn.commit()
+        
+        # 2) filtro de duplicatas da partição inteira
+        cursor.execute("SELECT COUNT(*) FROM arq.nota_fiscal")
+        total_keys = cursor.fetchone()[0] * 2
+        partition_filter = PartitionFilter(total_keys * ARCHIVE_FILTER_BITS_PER_KEY, ARCHIVE_FILTER_HASHES)
+        cursor.execute("SELECT hash_arquivo, chave_acesso FROM arq.nota_fiscal")
+        while True:
+            rows = cursor.fetchmany(ARCHIVE_BATCH_SIZE)
+            if not rows:
+                break
+            for hash_arq, chave in rows:
+                partition_filter.add(f"hash:{hash_arq}")
+                partition_filter.add(f"chave:{chave}")
+        cursor.execute(
+            "INSERT OR REPLACE INTO arq.filtro_dedup (id, num_bits, num_hashes, dados) VALUES (1, ?, ?, ?)",
+            (partition_filter.num_bits, partition_filter.num_hashes, bytes(partition_filter.data))
+        )
+        conn.commit()
+        
+        # 3) remove do banco principal em lotes curtos para não segurar o lock de escrita
+        moved = 0
+        while True:
+            cursor.execute('''
+                DELETE FROM main.nota_fiscal WHERE id IN (
+                    SELECT id FROM main.nota_fiscal
+                    WHERE data_emissao BETWEEN ? AND ?
+                      AND chave_acesso IN (SELECT chave_acesso FROM arq.nota_fiscal)
+                    LIMIT ?
+                )''', (inicio, fim, ARCHIVE_BATCH_SIZE))
+            conn.commit()
+            if cursor.rowcount <= 0:
+                break
+            moved += cursor.rowcount
+        
+        cursor.execute("DETACH DATABASE arq")
+    finally:
+        conn.close()
+    
+    os.chmod(path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+    logging.info(f"✓ {year}: {moved} nota(s) movida(s) para {path.name}")
+    return moved
+
+def archive_cold_years(hot_years: int = ARCHIVE_HOT_YEARS) -> int:
+    first_hot_year = datetime.now().year - hot_years + 1
+    ARCHIVE_DIRECTORY.mkdir(parents=True, exist_ok=True)
+    
+    conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT DISTINCT substr(data_emissao, 1, 4) FROM nota_fiscal WHERE data_emissao < ?",
+            (f"{first_hot_year}-01-01",)
+        )
+        years = sorted(int(row[0]) for row in cursor.fetchall())
+    finally:
+        conn.close()
+    
+    if not years:
+        logging.info(f"→ Nenhum ano anterior a {first_hot_year} para arquivar")
+        return 0
+    
+    logging.info(f"→ Arquivando anos {', '.join(map(str, years))} (mantendo {first_hot_year}+ no banco principal)")
+    return sum(archive_year(year) for year in years)
+
+EXPORT_COLUMNS = (
+    "id", "chave_acesso", "hash_arquivo", "data_processamento", "data_emissao",
+    "tipo_documento", "caminho_arquivo", "status", "created_at",
+    "empresa_cnpj", "empresa_nome"
+) + tuple(NOTA_EXTRA_COLUMNS)
+
+NOTA_PARTITION_COLUMNS = (
+    "id", "chave_acesso", "hash_arquivo", "empresa_id", "data_processamento", "data_emissao",
+    "tipo_documento", "caminho_arquivo", "status", "created_at"
+) + tuple(NOTA_EXTRA_COLUMNS)
+
+def connect_readonly(timeout: float = 10) -> sqlite3.Connection:
+    # mode=ro + WAL: leitura de um snapshot consistente sem bloquear o processo de ingestão
+    return sqlite3.connect(
+        readonly_uri(DATABASE_FILE), uri=True, timeout=timeout,
+        isolation_level=None, check_same_thread=False
+    )
+
+def attach_partition(conn: sqlite3.Connection, year: int) -> str:
+    schema = f"arq_{year}"
+    conn.execute(f"ATTACH DATABASE ? AS {schema}", (readonly_uri(get_archive_path(year)),))
+    return schema
+
+def nota_source_sql(conn: sqlite3.Connection, schema: str) -> str:
+    # Partições antigas podem não ter colunas criadas depois do arquivamento
+    if schema == "main":
+        return "main.nota_fiscal"
+    available = {row[1] for row in conn.execute(f"PRAGMA {schema}.table_info(nota_fiscal)")}
+    columns = ", ".join(c if c in available else f"NULL AS {c}" for c in NOTA_PARTITION_COLUMNS)
+    return f"(SELECT {columns} FROM {schema}.nota_fiscal)"
+
+def year_from_chave(chave: str):
+    # Posições 3-6 da chave de acesso: AAMM da emissão
+    if len(chave) == 44 and chave.isdigit():
+        return 2000 + int(chave[2:4])
+    return None
+
+EXPORT_SELECT = f'''
+    SELECT n.id, n.chave_acesso, n.hash_arquivo, n.data_processamento, n.data_emissao,
+           n.tipo_documento, n.caminho_arquivo, n.status, n.created_at,
+           e.cnpj, e.nome{''.join(f', n.{column}' for column in NOTA_EXTRA_COLUMNS)}
+    FROM {{source}} n
+    JOIN main.empresa e ON e.id = n.empresa_id
+    WHERE n.id > ? AND n.id <= ?
+'''
+
+def load_export_state(output_dir: Path) -> dict:
+    state_file = output_dir / "_export_state.json"
+    if not state_file.exists():
+        return {}
+    
+    return json.loads(state_file.read_text(encoding='utf-8'))
+
+def export_notas(output_dir: Path, fmt: str = "csv", full: bool = False) -> int:
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    state_file = output_dir / "_export_state.json"
+    extension = "csv.gz" if fmt == "csv" else "jsonl.gz"
+    
+    # Estado por formato: csv e jsonl no mesmo diretório seguem incrementos independentes
+    state = load_export_state(output_dir)
+    since_id = 0
+    if not full:
+        since_id = state.get(fmt, {}).get("last_id", 0)
+    
+    logging.info(f"→ Exportando nota_fiscal (id > {since_id}) para {output_dir} [{fmt}]")
+    start_time = time.time()
+    
+    conn = connect_readonly()
+    try:
+        cursor = conn.cursor()
+        
+        # Limite de id e anos fixados em um único snapshot: a exportação segue
+        # ano a ano, anexando só a partição daquele ano
+        cursor.execute("BEGIN")
+        cursor.execute("SELECT seq FROM main.sqlite_sequence WHERE name = 'nota_fiscal'")
+        row = cursor.fetchone()
+        last_id = row[0] if row else 0
+        # Nota ainda sendo movida para o destino pode ter a inserção desfeita: o limite
+        # fica abaixo da mais antiga, que entra na próxima exportação já concluída
+        cursor.execute("SELECT MIN(id) FROM main.nota_fiscal WHERE status = 'MOVENDO'")
+        in_flight = cursor.fetchone()[0]
+        if in_flight is not None:
+            last_id = min(last_id, in_flight - 1)
+        last_id = max(since_id, last_id)
+        cursor.execute(
+            "SELECT DISTINCT substr(data_emissao, 1, 4) FROM main.nota_fiscal WHERE id > ? AND id <= ?",
+            (since_id, last_id)
+        )
+        years = {int(row[0]) for row in cursor.fetchall()}
+        archives = list_archives()
+        cursor.execute("COMMIT")
+        years.update(archives)
+        
+        # Um arquivo por mês de emissão, fechado ao terminar o ano e publicado
+        # (rename) só no final, junto com o novo estado
+        partitions = {}
+        total = 0
+        try:
+            for year in sorted(years):
+                inicio, fim = f"{year}-01-01", f"{year}-12-31"
+                schema = None
+                cursor = conn.cursor()
+                
+                # "archive" copia para a partição antes de apagar do banco principal.
+                # Com o snapshot do principal já fixado, partição inexistente significa
+                # que nenhuma nota do ano saiu dele; se ela existe, um único SELECT lê o
+                # principal primeiro e ignora na partição as chaves ainda presentes nele
+                cursor.execute("BEGIN")
+                cursor.execute("SELECT 1 FROM main.nota_fiscal LIMIT 1").fetchall()
+                if get_archive_path(year).exists():
+                    cursor.execute("COMMIT")
+                    schema = attach_partition(conn, year)
+                
+                try:
+                    sql = EXPORT_SELECT.format(source="main.nota_fiscal") + " AND n.data_emissao BETWEEN ? AND ?"
+                    params = (since_id, last_id, inicio, fim)
+                    if schema:
+                        sql += (
+                            " UNION ALL " + EXPORT_SELECT.format(source=nota_source_sql(conn, schema)) +
+                            " AND NOT EXISTS (SELECT 1 FROM main.nota_fiscal m WHERE m.chave_acesso = n.chave_acesso)"
+                        )
+                        params += (since_id, last_id)
+                    cursor.execute(sql, params)
+                    
+                    year_partitions = {}
+                    while True:
+                        rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+                        if not rows:
+                            break
+                        
+                        for row in rows:
+                            mes_emissao = row[4][:7]
+                            partition = year_partitions.get(mes_emissao)
+                            
+                            if partition is None:
+                                partition_dir = output_dir / f"mes_emissao={mes_emissao}"
+                                partition_dir.mkdir(exist_ok=True)
+                                tmp_path = partition_dir / f".nota_fiscal_{since_id + 1:010d}.{extension}.tmp"
+                                handle = gzip.open(tmp_path, "wt", encoding="utf-8", newline="")
+                                writer = csv.writer(handle) if fmt == "csv" else None
+                                if writer:
+                                    writer.writerow(EXPORT_COLUMNS)
+                                partition = {"dir": partition_dir, "tmp": tmp_path, "handle": handle, "writer": writer}
+                                year_partitions[mes_emissao] = partition
+                                partitions[mes_emissao] = partition
+                            
+                            if partition["writer"]:
+                                partition["writer"].writerow(row)
+                            else:
+                                partition["handle"].write(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False))
+                                partition["handle"].write("\n")
+                        
+                        total += len(rows)
+                    
+                    for partition in year_partitions.values():
+                        partition["handle"].close()
+                finally:
+                    cursor.close()
+                    if schema:
+                        conn.execute(f"DETACH DATABASE {schema}")
+                    else:
+                        conn.execute("COMMIT")
+        
+        except Exception:
+            for partition in partitions.values():
+                partition["handle"].close()
+                partition["tmp"].unlink()
+            raise
+    finally:
+        conn.close()
+    
+    published = set()
+    for partition in partitions.values():
+        final_path = partition["dir"] / f"nota_fiscal_{since_id + 1:010d}-{last_id:010d}.{extension}"
+        os.replace(partition["tmp"], final_path)
+        published.add(final_path)
+    
+    # --full substitui a exportação anterior do mesmo formato: os arquivos
+    # incrementais antigos duplicariam as linhas para quem lê a partição inteira
+    if full:
+        removed = 0
+        for old_file in output_dir.glob(f"mes_emissao=*/nota_fiscal_*.{extension}"):
+            if old_file not in published:
+                old_file.unlink()
+                removed += 1
+        for partition_dir in output_dir.glob("mes_emissao=*"):
+            if partition_dir.is_dir() and not any(partition_dir.iterdir()):
+                partition_dir.rmdir()
+        if removed:
+            logging.info(f"  {removed} arquivo(s) da exportação anterior removido(s)")
+    
+    state[fmt] = {"last_id": last_id}
+    tmp_state = state_file.with_suffix(".tmp")
+    tmp_state.write_text(json.dumps(state), encoding='utf-8')
+    os.replace(tmp_state, state_file)
+    
+    elapsed = time.time() - start_time
+    logging.info(
+        f"✓ Exportação: {total} nota(s) em {len(partitions)} partição(ões) | "
+        f"Último id: {last_id} | Tempo: {elapsed:.1f}s"
+    )
+    return total
+
+class LookupCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[0] > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+    
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+class ReadOnlyPool:
+    # Cada conexão abre só o banco principal; as partições são anexadas sob demanda
+    # e as menos usadas desanexadas ao passar de ARCHIVE_ATTACHED_MAX
+    def __init__(self, size: int):
+        self._connections = queue.Queue()
+        self._lock = Lock()
+        self._signature = get_archive_signature()
+        self._archive_years = {year for year, _ in self._signature}
+        self._generation = 0
+        self._checked_at = time.time()
+        for _ in range(size):
+            self._connections.put((connect_readonly(), OrderedDict(), self._generation))
+    
+    def _check_archives(self):
+        # Partições criadas depois da abertura do pool: as conexões são refeitas ao serem usadas
+        with self._lock:
+            if time.time() - self._checked_at < ARCHIVE_CHECK_INTERVAL:
+                return
+            self._checked_at = time.time()
+            signature = get_archive_signature()
+            if signature != self._signature:
+                self._signature = signature
+                self._archive_years = {year for year, _ in signature}
+                self._generation += 1
+    
+    def archive_years(self, first_year: int = 0, last_year: int = 9999) -> list:
+        return sorted(year for year in self._archive_years if first_year <= year <= last_year)
+    
+    @contextmanager
+    def connection(self):
+        self._check_archives()
+        conn, attached, generation = self._connections.get()
+        try:
+            if generation != self._generation:
+                conn.close()
+                conn, attached, generation = connect_readonly(), OrderedDict(), self._generation
+            yield conn, attached
+        finally:
+            self._connections.put((conn, attached, generation))
+    
+    def _attach(self, conn: sqlite3.Connection, attached: OrderedDict, year: int) -> str:
+        if year in attached:
+            attached.move_to_end(year)
+            return attached[year]
+        while len(attached) >= ARCHIVE_ATTACHED_MAX:
+            _, schema = attached.popitem(last=False)
+            conn.execute(f"DETACH DATABASE {schema}")
+        attached[year] = attach_partition(conn, year)
+        return attached[year]
+    
+    def query(self, sql: str, params: tuple = ()) -> list:
+        with self.connection() as (conn, _):
+            cursor = conn.execute(sql, params)
+            columns = [col[0] for col in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    
+    def query_notas(self, where: str, params: tuple, years: list) -> list:
+        # Banco principal e cada partição em consultas separadas, mescladas por id:
+        # uma nota arquivada entre as duas consultas aparece só uma vez
+        notas = {}
+        with self.connection() as (conn, attached):
+            for year in [None] + years:
+                schema = "main" if year is None else self._attach(conn, attached, year)
+                cursor = conn.execute(
+                    lookup_nota_sql(nota_source_sql(conn, schema)) + where +
+                    " ORDER BY n.data_emissao, n.id LIMIT ?",
+                    params + (LOOKUP_MAX_RESULTS,)
+                )
+                columns = [col[0] for col in cursor.description]
+                for row in cursor.fetchall():
+                    nota = dict(zip(columns, row))
+                    notas.setdefault(nota["id"], nota)
+        
+        return sorted(notas.values(), key=lambda n: (n["data_emissao"], n["id"]))[:LOOKUP_MAX_RESULTS]
+
+def lookup_nota_sql(source: str) -> str:
+    return f'''
+    SELECT n.id, n.chave_acesso, n.data_emissao, n.data_processamento, n.tipo_documento,
+           n.caminho_arquivo, n.status, e.cnpj AS empresa_cnpj, e.nome AS empresa_nome{''.join(f', n.{column}' for column in NOTA_EXTRA_COLUMNS)}
+    FROM {source} n
+    JOIN main.empresa e ON e.id = n.empresa_id
+    '''
+
+class LookupHandler(BaseHTTPRequestHandler):
+    server_version = "XMLOrganizerLookup/1.0"
+    
+    def log_message(self, format, *args):
+        # Uma linha por requisição poluiria o log com centenas de consultas por segundo
+        pass
+    
+    def do_GET(self):
+        try:
+            url = urlparse(self.path)
+            parts = [unquote(p) for p in url.path.strip("/").split("/") if p]
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            
+            if len(parts) == 3 and parts[0] == "notas" and parts[2] == "xml":
+                self.send_xml(parts[1])
+            elif len(parts) == 2 and parts[0] == "notas":
+                nota = self.query_chave(parts[1])
+                if nota:
+                    self.send_json(200, nota[0])
+                else:
+                    self.send_json(404, {"erro": "Nota não encontrada"})
+            elif parts == ["notas"] and "cnpj" in params:
+                self.send_notas_por_cnpj(params)
+            elif parts == ["empresas"] and "nome" in params:
+                self.send_empresas_por_nome(params["nome"])
+            else:
+                self.send_json(404, {"erro": "Rota não encontrada"})
+        
+        except sqlite3.Error as e:
+            logging.error(f"Erro na consulta {self.path}: {e}")
+            self.send_json(503, {"erro": "Banco indisponível"})
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+    
+    def cached_query(self, key: tuple, query, *args) -> list:
+        result = self.server.cache.get(key)
+        if result is None:
+            result = query(*args)
+            self.server.cache.put(key, result)
+        return result
+    
+    def query_chave(self, chave: str) -> list:
+        # Só a partição do ano da chave é consultada
+        year = year_from_chave(chave)
+        pool = self.server.pool
+        years = pool.archive_years(year, year) if year else []
+        return self.cached_query(("chave", chave), pool.query_notas, " WHERE n.chave_acesso = ?", (chave,), years)
+    
+    def send_notas_por_cnpj(self, params: dict):
+        cnpj = re.sub(r'\D', '', params["cnpj"])
+        data_inicio = params.get("de", "0000-00-00")
+        data_fim = params.get("ate", "9999-99-99")
+        
+        try:
+            years = self.server.pool.archive_years(int(data_inicio[:4]), int(data_fim[:4]))
+        except ValueError:
+            self.send_json(400, {"erro": "Datas devem estar no formato AAAA-MM-DD"})
+            return
+        
+        notas = self.cached_query(
+            ("cnpj", cnpj, data_inicio, data_fim),
+            self.server.pool.query_notas,
+            " WHERE e.cnpj = ? AND n.data_emissao BETWEEN ? AND ?",
+            (cnpj, data_inicio, data_fim),
+            years
+        )
+        self.send_json(200, {"total": len(notas), "notas": notas})
+    
+    def send_empresas_por_nome(self, prefixo: str):
+        prefixo = standardize_company_name(prefixo)
+        if not prefixo:
+            self.send_json(400, {"erro": "Prefixo vazio"})
+            return
+        
+        # Intervalo [prefixo, prefixo + U+FFFF) usa o índice idx_empresa_nome, ao contrário do LIKE
+        empresas = self.cached_query(
+            ("nome", prefixo),
+            self.server.pool.query,
+            "SELECT id, cnpj, nome FROM empresa WHERE nome >= ? AND nome < ? ORDER BY nome LIMIT ?",
+            (prefixo, prefixo + "\uffff", LOOKUP_MAX_RESULTS)
+        )
+        self.send_json(200, {"total": len(empresas), "empresas": empresas})
+    
+    def send_xml(self, chave: str):
+        nota = self.query_chave(chave)
+        if not nota:
+            self.send_json(404, {"erro": "Nota não encontrada"})
+            return
+        
+        xml_path = Path(nota[0]["caminho_arquivo"])
+        try:
+            f = open(xml_path, "rb")
+        except OSError:
+            self.send_json(404, {"erro": "Arquivo não encontrado no destino"})
+            return
+        
+        with f:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/xml")
+            self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+            self.send_header("Content-Disposition", f'attachment; filename="{xml_path.name}"')
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile, 65536)
+    
+    def send_json(self, status: int, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class LookupServer(ThreadingMixIn, HTTPServer):
+    # Equivalente ao ThreadingHTTPServer, que só existe a partir do Python 3.7
+    daemon_threads = True
+
+def run_lookup_server(host: str = LOOKUP_HOST, port: int = LOOKUP_PORT):
+    server = LookupServer((host, port), LookupHandler)
+    server.pool = ReadOnlyPool(LOOKUP_POOL_SIZE)
+    server.cache = LookupCache(LOOKUP_CACHE_SIZE, LOOKUP_CACHE_TTL)
+    
+    logging.info(f"✓ Serviço de consulta em http://{host}:{port} (somente leitura)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("\n⊗ Finalizando serviço de consulta")
+    finally:
+        server.server_close()
+
 def verify_database_integrity():
     try:
         conn = sqlite3.connect(DATABASE_FILE)
@@ -602,12 +1694,21 @@ def verify_database_integrity():
         """)
         tipos = cursor.fetchall()
         
+        cursor.execute("SELECT COUNT(*), COALESCE(SUM(ocorrencias), 0) FROM arquivo_invalido")
+        total_quarentena, total_ocorrencias = cursor.fetchone()
+        
         conn.close()
         
         logging.info(f"  📊 Banco: {total_notas} notas de {total_empresas} empresas")
         if tipos:
             tipo_str = ", ".join([f"{t[0]}: {t[1]}" for t in tipos])
             logging.info(f"     Tipos: {tipo_str}")
+        if total_quarentena:
+            logging.info(f"     Quarentena: {total_quarentena} arquivo(s), {total_ocorrencias} ocorrência(s)")
+        
+        archives = list_archives()
+        if archives:
+            logging.info(f"     Partições arquivadas: {', '.join(map(str, archives))}")
         
     except Exception as e:
         logging.warning(f"Aviso ao verificar integridade: {e}")
@@ -618,32 +1719,84 @@ def main():
     logging.info(f"Monitorando: {SOURCE_DIRECTORY}")
     logging.info(f"Destino: {DESTINATION_NETWORK_DIRECTORY}")
     logging.info(f"Banco de dados: {DATABASE_FILE}")
-    logging.info(f"Workers: {MAX_WORKERS} | Batch: {BATCH_SIZE}")
+    logging.info(f"Workers: {MAX_WORKERS} | Batch: {BATCH_SIZE} | Shards: {SHARD_COUNT}")
     logging.info("="*60)
     
     setup_database()
     migrate_old_database()
-    load_caches()
+    recover_pending_moves()
     verify_database_integrity()
     
+    if SHARD_COUNT > 1:
+        logging.info(f"\n🔍 Modo multiprocesso: {SHARD_COUNT} shards")
+        logging.info("  • Arquivos reivindicados por rename atômico")
+        logging.info("  • Duplicatas detectadas por: constraints UNIQUE do banco\n")
+        run_supervisor()
+        return
+    
+    requeue_orphan_inboxes(0)
+    load_caches()
+    
     logging.info("\n🔍 Modo de operação:")
     logging.info("  • Empresas identificadas APENAS por CNPJ")
     logging.info("  • Nome atualizado automaticamente se mudar no XML")
     logging.info("  • Duplicatas detectadas por: hash + chave + banco\n")
     
+    run_processing_loop()
+
+def run_processing_loop(stop_event: Event = None):
+    # stop_event permite encerrar o loop de fora (ex.: soak_test.py); o serviço roda sem ele
+    def wait(seconds):
+        if stop_event is None:
+            time.sleep(seconds)
+        else:
+            stop_event.wait(seconds)
+    
     cycle = 0
-    while True:
+    while stop_event is None or not stop_event.is_set():
         try:
             cycle += 1
-            scan_and_process()
-            time.sleep(SCAN_INTERVAL)
+            pending = scan_and_process()
+            
+            # Arquivos aguardando estabilizar são reavaliados antes do próximo ciclo normal
+            wait(min(SCAN_INTERVAL, FILE_STABLE_SECONDS) if pending else SCAN_INTERVAL)
             
         except KeyboardInterrupt:
             logging.info("\n⊗ Finalizando por solicitação do usuário")
             break
         except Exception as e:
             logging.error(f"✗ Erro no ciclo {cycle}: {e}")
-            time.sleep(10)
+            wait(10)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="XML Organizer - NF-e/NFC-e")
+    subparsers = parser.add_subparsers(dest="command")
+    
+    export_parser = subparsers.add_parser("export", help="Exporta nota_fiscal + empresa para BI")
+    export_parser.add_argument("--format", choices=["csv", "jsonl"], default="csv",
+                               help="Formato de saída (compactado com gzip)")
+    export_parser.add_argument("--output", type=Path, default=EXPORT_DIRECTORY,
+                               help="Diretório de saída, particionado por mês de emissão")
+    export_parser.add_argument("--full", action="store_true",
+                               help="Exporta tudo desde o id 1, substituindo os arquivos já exportados no formato")
+    
+    archive_parser = subparsers.add_parser("archive", help="Move anos fechados para partições somente leitura")
+    archive_parser.add_argument("--hot-years", type=int, default=ARCHIVE_HOT_YEARS,
+                                help="Anos recentes mantidos no banco principal (inclui o atual)")
+    
+    serve_parser = subparsers.add_parser("serve", help="Serviço HTTP/JSON de consulta de notas")
+    serve_parser.add_argument("--host", default=LOOKUP_HOST)
+    serve_parser.add_argument("--port", type=int, default=LOOKUP_PORT)
+    
+    return parser.parse_args()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parse_args()
+    if args.command == "export":
+        export_notas(args.output, args.format, args.full)
+    elif args.command == "archive":
+        archive_cold_years(args.hot_years)
+    elif args.command == "serve":
+        run_lookup_server(args.host, args.port)
+    else:
+        main()
\ No newline at end of file